@@ -1,20 +1,120 @@
 from flask import Flask, render_template, request, redirect, url_for, jsonify, send_file, make_response
 import os
 import uuid
-import json
-import shutil
+import time
+import orjson
 import base64
-from werkzeug.utils import secure_filename
-from detect import analyze_panorama
+import hashlib
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from streaming_form_data import StreamingFormDataParser
+from streaming_form_data.parser import ParseFailedException
+from streaming_form_data.targets import FileTarget
+from detect import analyze_panorama, write_json
 
 app = Flask(__name__)
-app.config['UPLOAD_FOLDER'] = 'static/uploads'
 app.config['PROCESSED_FOLDER'] = 'static/processed'
+# Outside static/ and not addressable by any <id> route
+app.config['CACHE_FOLDER'] = 'cache'
 app.config['MAX_CONTENT_LENGTH'] = 100 * 1024 * 1024 # 100 MB limit
 
 # Ensure directories exist
-os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 os.makedirs(app.config['PROCESSED_FOLDER'], exist_ok=True)
+os.makedirs(app.config['CACHE_FOLDER'], exist_ok=True)
+
+# AI analysis runs in the background so /detect can redirect immediately.
+# Running jobs are tracked with a <id>.pending marker file rather than in
+# memory, so any worker process can answer /api/status/<id>
+executor = ThreadPoolExecutor(max_workers=8)
+
+# A job still pending after this long belongs to a worker that was killed
+# or restarted mid-job, and is treated as failed
+JOB_TIMEOUT = 15 * 60  # seconds
+
+def pending_path(id):
+    return os.path.join(app.config['PROCESSED_FOLDER'], f"{id}.pending")
+
+def job_pending(id):
+    """True while the analysis for id is running (marker holds its start time)."""
+    try:
+        with open(pending_path(id)) as f:
+            started = float(f.read())
+    except FileNotFoundError:
+        return False
+    except ValueError:
+        started = 0.0
+    if time.time() - started > JOB_TIMEOUT:
+        remove_pending(id)
+        return False
+    return True
+
+def remove_pending(id):
+    try:
+        os.remove(pending_path(id))
+    except FileNotFoundError:
+        pass
+
+class HashingFileTarget(FileTarget):
+    """FileTarget that also BLAKE2b-hashes the bytes as they are written."""
+
+    def __init__(self, filename, *args, **kwargs):
+        super().__init__(filename, *args, **kwargs)
+        self.hash = hashlib.blake2b(digest_size=16)
+        self.finished = False
+
+    def on_data_received(self, chunk):
+        self.hash.update(chunk)
+        super().on_data_received(chunk)
+
+    def on_finish(self):
+        super().on_finish()
+        # Only set once the closing boundary of the part has been parsed
+        self.finished = True
+
+    def discard(self):
+        """Closes and deletes a partially written file."""
+        if self._fd and not self._fd.closed:
+            self._fd.close()
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+def copy_json(src, dst):
+    """Copies a JSON file via write_json, so readers never see a partial copy."""
+    with open(src, 'rb') as f:
+        write_json(dst, orjson.loads(f.read()))
+
+def analyze_and_cache(file_id, image_path, prompt, json_path, cache_path):
+    """Runs the AI and stores the result under the image hash for reuse."""
+    try:
+        data = analyze_panorama(image_path, prompt, json_path)
+        if os.path.exists(json_path):
+            copy_json(json_path, cache_path)
+        return data
+    except Exception as e:
+        # Nobody reads the Future, so report failures here
+        print(f"❌ Analysis failed for {file_id}: {e!r}")
+        return []
+    finally:
+        remove_pending(file_id)
+
+@functools.lru_cache(maxsize=256)
+def _read_hotspots(json_path, version):
+    # version is (mtime_ns, inode, size). write_json replaces the file with a
+    # new inode, so a rewrite misses even within one coarse mtime tick
+    with open(json_path, 'rb') as f:
+        return f.read()
+
+def load_hotspots(id):
+    """
+    Returns the stored hotspot JSON bytes for a panorama, or None.
+    Repeated polls are served from memory until the file changes.
+    """
+    json_path = os.path.join(app.config['PROCESSED_FOLDER'], f"{id}.json")
+    try:
+        st = os.stat(json_path)
+    except FileNotFoundError:
+        return None
+    return _read_hotspots(json_path, (st.st_mtime_ns, st.st_ino, st.st_size))
 
 @app.route('/')
 def index():
@@ -22,15 +122,33 @@ def index():
 
 @app.route('/detect', methods=['POST'])
 def detect():
-    if 'image' not in request.files:
-        return redirect(request.url)
-    
-    file = request.files['image']
-    if file.filename == '':
-        return redirect(request.url)
-    
-    file = request.files['image']
-    if file.filename == '':
+    file_id = str(uuid.uuid4())
+    # Save once, directly as the "panorama" source for that ID
+    file_path = os.path.join(app.config['PROCESSED_FOLDER'], f"{file_id}.jpg")
+
+    # Stream the multipart body straight to disk instead of going through
+    # Werkzeug's form parser, which is very slow on large panoramas.
+    # The image is hashed on the way through for the result cache
+    target = HashingFileTarget(file_path)
+    parsed = False
+    try:
+        # Raises for a missing or non-multipart Content-Type
+        parser = StreamingFormDataParser(headers=request.headers)
+        parser.register('image', target)
+        while chunk := request.stream.read(65536):
+            parser.data_received(chunk)
+        # A body cut off before the closing boundary just hits EOF, so
+        # check the image part was actually completed
+        parsed = target.finished and bool(target.multipart_filename)
+    except ParseFailedException:
+        pass
+    finally:
+        # Also runs when the client disconnects mid-upload; that error
+        # still propagates as a 400 after the partial file is removed
+        if not parsed:
+            target.discard()
+
+    if not parsed:
         return redirect(request.url)
     
     # Hardcoded prompt as requested
@@ -102,53 +220,95 @@ Sort by x (ascending).
 # Output ONLY valid JSON."""
 
 
-    file_id = str(uuid.uuid4())
-    filename = secure_filename(file.filename)
-    # Use ID in filename to avoid collisions but keep extension
-    ext = os.path.splitext(filename)[1]
-    saved_filename = f"{file_id}{ext}"
-    file_path = os.path.join(app.config['UPLOAD_FOLDER'], saved_filename)
-    file.save(file_path)
-
-    # Process
-    # We copy the image to procssed folder as the "panorama" source for that ID
-    processed_img_path = os.path.join(app.config['PROCESSED_FOLDER'], f"{file_id}.jpg")
-    shutil.copy(file_path, processed_img_path)
-    
     json_path = os.path.join(app.config['PROCESSED_FOLDER'], f"{file_id}.json")
     
-    # Run AI
-    # analyze_panorama(file_path, prompt, json_path)
+    # Identical images were already analyzed: reuse the cached result
+    cache_path = os.path.join(app.config['CACHE_FOLDER'], f"{target.hash.hexdigest()}.json")
+    if os.path.exists(cache_path):
+        copy_json(cache_path, json_path)
+        return redirect(url_for('view_panorama', id=file_id))
+
+    # Run AI in the background; the viewer polls /api/status/<id> until done
+    with open(pending_path(file_id), 'w') as f:
+        f.write(str(time.time()))
+    executor.submit(analyze_and_cache, file_id, file_path, prompt, json_path, cache_path)
     
     return redirect(url_for('view_panorama', id=file_id))
 
+def render_cached(template, id, **context):
+    """
+    Renders a page for a panorama with an ETag based on the template and
+    JSON mtimes. Returns 304 without rendering when the client copy is
+    still current.
+    """
+    json_path = os.path.join(app.config['PROCESSED_FOLDER'], f"{id}.json")
+    try:
+        json_mtime_ns = os.stat(json_path).st_mtime_ns
+    except FileNotFoundError:
+        # Analysis still running (or its partial file was just removed),
+        # nothing stable to cache against yet
+        return render_template(template, id=id, **context)
+
+    # The template mtime makes a deploy that changes the page a cache miss
+    template_path = os.path.join(app.root_path, app.template_folder, template)
+    etag = f"{os.stat(template_path).st_mtime_ns:x}-{json_mtime_ns:x}"
+    if request.if_none_match.contains(etag):
+        response = make_response('', 304)
+    else:
+        response = make_response(render_template(template, id=id, **context))
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = 60
+    return response
+
 @app.route('/view/<id>')
 def view_panorama(id):
-    return render_template('viewer.html', id=id)
+    return render_cached('viewer.html', id)
 
 @app.route('/share/<id>')
 def share_panorama(id):
-    return render_template('viewer.html', id=id, shared=True)
+    return render_cached('viewer.html', id, shared=True)
 
 @app.route('/edit/<id>')
 def edit_panorama(id):
-    return render_template('editor.html', id=id)
+    return render_cached('editor.html', id)
+
+@app.route('/image/<id>')
+def panorama_image(id):
+    # conditional=True adds ETag/Last-Modified and Range support, so the
+    # browser can cache large panoramas and resume interrupted downloads
+    img_path = os.path.join(app.config['PROCESSED_FOLDER'], f"{id}.jpg")
+    if os.path.exists(img_path):
+        # send_file resolves relative paths against app.root_path, not the
+        # working directory the folders are created in
+        return send_file(os.path.abspath(img_path), mimetype='image/jpeg', conditional=True, etag=True, max_age=86400)
+    return jsonify({"error": "File not found"}), 404
 
 @app.route('/api/data/<id>')
 def get_data(id):
-    json_path = os.path.join(app.config['PROCESSED_FOLDER'], f"{id}.json")
-    if os.path.exists(json_path):
-        with open(json_path, 'r') as f:
-            data = json.load(f)
-        return jsonify(data)
+    data = load_hotspots(id)
+    if data is not None:
+        # The file is already valid JSON, serve the bytes as-is
+        return app.response_class(data, mimetype='application/json')
     return jsonify([])
 
+@app.route('/api/status/<id>')
+def get_status(id):
+    # The JSON file is written progressively while the AI streams, so only
+    # the pending marker can say when results are final
+    return jsonify({"ready": not job_pending(id)})
+
 @app.route('/api/save/<id>', methods=['POST'])
 def save_data(id):
-    data = request.json
+    # The running analysis would overwrite the edits (and cache them)
+    if job_pending(id):
+        return jsonify({"error": "Detection is still running, try again shortly."}), 409
+    try:
+        data = orjson.loads(request.get_data())
+    except orjson.JSONDecodeError:
+        return jsonify({"error": "Invalid JSON"}), 400
     json_path = os.path.join(app.config['PROCESSED_FOLDER'], f"{id}.json")
-    with open(json_path, 'w') as f:
-        json.dump(data, f, indent=2)
+    write_json(json_path, data)
     return jsonify({"status": "success"})
 
 @app.route('/download/<id>')
@@ -165,12 +325,13 @@ def download(id):
     # Strategy: Render a template that has the JSON embedded directly in a <script> variable
     # instead of fetching it. User can then "Save Page As".
     
-    json_path = os.path.join(app.config['PROCESSED_FOLDER'], f"{id}.json")
-    if os.path.exists(json_path):
-        with open(json_path, 'r') as f:
-            hotspots_data = json.load(f)
+    # Splice the stored JSON in verbatim; only escape "</" so a label
+    # can never close the surrounding <script> tag
+    data = load_hotspots(id)
+    if data is not None:
+        hotspots_data = data.decode('utf-8').replace('</', '<\\/')
     else:
-        hotspots_data = []
+        hotspots_data = '[]'
 
     # Encode Panorama Image as Base64
     img_path = os.path.join(app.config['PROCESSED_FOLDER'], f"{id}.jpg")
@@ -188,7 +349,7 @@ def download(id):
 
     response_html = render_template('viewer_standalone.html', 
                                    id=id, 
-                                   hotspots_data=json.dumps(hotspots_data),
+                                   hotspots_data=hotspots_data,
                                    panorama_b64=panorama_b64,
                                    icon_b64=icon_b64,
                                    base_url=request.url_root)
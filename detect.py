@@ -5,11 +5,29 @@ Reusable Building Detection Module for 360° Panoramas
 from google import genai
 from google.genai import types
 import PIL.Image
+import httpx
+import numpy as np
+import io
+import functools
 import os
 import re
-import json
+import string
+import tempfile
+import orjson
 from dotenv import load_dotenv
 
+# Matches [y, x]
+_POINT_RE = re.compile(r'\[\s*(\d+(?:\.\d+)?)\s*,\s*(\d+(?:\.\d+)?)\s*\]')
+
+# Hotspot labels: A..Z, then AA..ZZ
+_LABELS = list(string.ascii_uppercase) + [a + b for a in string.ascii_uppercase for b in string.ascii_uppercase]
+
+# Process umask, read once at import while still single-threaded (os.umask
+# can only be queried by setting it). Used to give write_json's temp files
+# the same mode a plain open() would
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
 # Allow loading huge images
 PIL.Image.MAX_IMAGE_PIXELS = None
 
@@ -17,8 +35,131 @@ PIL.Image.MAX_IMAGE_PIXELS = None
 load_dotenv()
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 
-# Initialize client
-client = genai.Client(api_key=GOOGLE_API_KEY)
+@functools.cache
+def get_client():
+    """
+    Shared Gemini client backed by a keep-alive HTTP/2 connection pool, so
+    the TLS handshake is paid once per process rather than per call.
+    Created lazily so forked WSGI workers each build their own pool.
+    """
+    http_client = httpx.Client(
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=20),
+        timeout=None,
+    )
+    return genai.Client(
+        api_key=GOOGLE_API_KEY,
+        http_options=types.HttpOptions(httpx_client=http_client),
+    )
+
+def _build_buildings(matches):
+    """
+    Converts regex [y, x] matches (0-1000 range) into labelled hotspots,
+    sorted left to right.
+    """
+    # Parse points into an (N, 2) array of [y, x] and sort by x (Left to Right)
+    # The regex only captures digit groups, so the conversion cannot fail
+    points = np.array(matches, dtype=np.float64)
+    points = points[points[:, 1].argsort(kind='stable')]
+    norm_y, norm_x = points[:, 0], points[:, 1]
+    
+    # Convert 0-1000 range to Yaw/Pitch, as one (N, 2) array of [yaw, pitch]
+    # Yaw: -180 to 180
+    # Pitch: 90 (up) to -90 (down)
+    # 0 on image = top = 90 deg pitch
+    # 1000 on image = bottom = -90 deg pitch
+    angles = np.column_stack((norm_x * 0.36 - 180.0, 90.0 - norm_y * 0.18))
+    # Rounded once, only for readability of the saved JSON. The normalized
+    # coordinates are kept at full precision
+    angles.round(2, out=angles)
+    
+    buildings_data = []
+    for i, ((yaw, pitch), (y, x)) in enumerate(zip(angles.tolist(), points.tolist())):
+        buildings_data.append({
+            "id": str(i),
+            "label": _LABELS[i],
+            "yaw": yaw,
+            "pitch": pitch,
+            "y_norm": y, 
+            "x_norm": x
+        })
+    return buildings_data
+
+def write_json(path, data):
+    """
+    Writes JSON via a temp file + fsync + os.replace, so concurrent readers
+    see either the old or the new file, never a truncated one.
+    """
+    # A unique temp file per call, so concurrent writers of the same path
+    # never share (or rename away) each other's temp file
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".tmp")
+    try:
+        # mkstemp creates the file as 0600, and os.replace would keep that
+        os.chmod(tmp_path, 0o666 & ~_UMASK)
+        with os.fdopen(fd, "wb") as f:
+            f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+class _PublishError(Exception):
+    """Raised when on_points fails; a local error, not a model error."""
+
+def _stream_detection(model, contents, on_points):
+    """
+    Streams the model response and parses points as they arrive.
+    Calls on_points(matches) with all points so far whenever new ones are found.
+    Returns (full_text, matches).
+    """
+    text_buffer = ""
+    last_pos = 0
+    matches = []
+    for chunk in get_client().models.generate_content_stream(model=model, contents=contents):
+        if not chunk.text:
+            continue
+        text_buffer += chunk.text
+        # A point split across chunks has no closing bracket yet, so it
+        # simply matches on a later pass
+        found = False
+        for m in _POINT_RE.finditer(text_buffer, last_pos):
+            matches.append(m.groups())
+            last_pos = m.end()
+            found = True
+        if found:
+            try:
+                on_points(matches)
+            except Exception as e:
+                raise _PublishError(e) from e
+    return text_buffer, matches
+
+def _detect_with_fallback(contents, on_points):
+    """
+    Runs streaming detection on the primary model, retrying once on the
+    backup model. Returns (full_text, matches), or None if both fail.
+    """
+    # _PublishError (e.g. disk full) propagates: retrying the paid request
+    # on the backup model would only hit the same local failure
+    try:
+        return _stream_detection(
+            'gemini-3-pro-image-preview', # Using smaller/faster model if available, or fallback
+            contents, on_points
+        )
+    except _PublishError:
+        raise
+    except Exception as e:
+        # Fallback or error handling
+        print(f"❌ AI Error (trying backup model): {e}")
+    try:
+        return _stream_detection('gemini-3-pro-preview', contents, on_points)
+    except _PublishError:
+        raise
+    except Exception as e2:
+        print(f"❌ AI Error 2: {e2}")
+        return None
 
 def analyze_panorama(image_path, prompt_text, output_json_path=None):
     """
@@ -32,98 +173,72 @@ def analyze_panorama(image_path, prompt_text, output_json_path=None):
         img = PIL.Image.open(image_path)
         
         # Resize for AI (speeds up upload and processing significantly)
-        ai_img = img.copy()
-        ai_img.thumbnail((2048, 2048))
+        # draft() lets libjpeg downscale while decoding, so the full-size
+        # panorama is never materialized (no-op for non-JPEG files)
+        img.draft('RGB', (2048, 2048))
+        img.thumbnail((2048, 2048), PIL.Image.Resampling.BILINEAR)
+        ai_img = img
         print(f"   Resized for AI: {ai_img.size}")
         
+        # Encode once; the upload below sends these bytes
+        if ai_img.mode != 'RGB':
+            ai_img = ai_img.convert('RGB')
+        buf = io.BytesIO()
+        ai_img.save(buf, 'JPEG', quality=80, optimize=False, progressive=False)
+        buf.seek(0)
+        
     except Exception as e:
         print(f"❌ Error loading image: {e}")
         return []
 
     print(f"🤖 Running AI detection...")
     
+    def on_points(matches):
+        # Publish partial results so /api/data can serve them while streaming
+        if output_json_path:
+            write_json(output_json_path, _build_buildings(matches))
+    
+    # Upload the image once through the Files API; the primary and fallback
+    # calls both reference the server-side copy instead of re-sending it
     try:
-        response = client.models.generate_content(
-            model='gemini-3-pro-image-preview', # Using smaller/faster model if available, or fallback
-            contents=[prompt_text, ai_img]
-        )
+        client = get_client()
+        file_ref = client.files.upload(file=buf, config={'mime_type': 'image/jpeg'})
     except Exception as e:
-        # Fallback or error handling
-        print(f"❌ AI Error (trying backup model): {e}")
+        print(f"❌ Upload Error: {e}")
+        return []
+
+    try:
+        result = _detect_with_fallback([prompt_text, file_ref], on_points)
+    except _PublishError as e:
+        print(f"❌ Error saving results: {e.__cause__}")
+        return []
+    finally:
+        # Don't let uploaded panoramas accumulate in storage
         try:
-             response = client.models.generate_content(
-                model='gemini-3-pro-preview',
-                contents=[prompt_text, ai_img]
-            )
-        except Exception as e2:
-             print(f"❌ AI Error 2: {e2}")
-             return []
-
-    text_response = ""
-    if response.candidates and response.candidates[0].content.parts:
-        for part in response.candidates[0].content.parts:
-            if hasattr(part, 'text') and part.text:
-                text_response += part.text
+            client.files.delete(name=file_ref.name)
+        except Exception as e:
+            print(f"⚠️ Could not delete uploaded file: {e}")
+
+    text_response, matches = result or ("", [])
+    if not matches and output_json_path and os.path.exists(output_json_path):
+        # Don't leave partial results from a failed primary run behind
+        os.remove(output_json_path)
+
+    if result is None:
+        return []
 
     if not text_response:
         print("⚠️ No response from AI.")
         return []
 
-    # Matches [y, x]
-    point_pattern = r'\[\s*(\d+(?:\.\d+)?)\s*,\s*(\d+(?:\.\d+)?)\s*\]'
-    matches = re.findall(point_pattern, text_response)
-    
-    buildings_data = []
-    
     if matches:
         print(f"📍 Found {len(matches)} building points.")
-        
-        # Parse points
-        points = []
-        for y_str, x_str in matches:
-            try:
-                points.append((float(y_str), float(x_str)))
-            except ValueError:
-                continue
-                
-        # Sort by x (Left to Right)
-        points.sort(key=lambda p: p[1])
-        
-        alphabet = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
-        
-        for i, (norm_y, norm_x) in enumerate(points):
-            if i < 26:
-                label_text = alphabet[i]
-            else:
-                label_text = alphabet[(i // 26) - 1] + alphabet[i % 26]
-            
-            # Convert 0-1000 range to Yaw/Pitch
-            # Yaw: -180 to 180
-            yaw = (norm_x / 1000.0) * 360.0 - 180.0
-            
-            # Pitch: 90 (up) to -90 (down)
-            # 0 on image = top = 90 deg pitch
-            # 1000 on image = bottom = -90 deg pitch
-            pitch = 90.0 - (norm_y / 1000.0) * 180.0
-            
-            buildings_data.append({
-                "id": str(i),
-                "label": label_text,
-                "yaw": round(yaw, 2),
-                "pitch": round(pitch, 2),
-                "y_norm": norm_y, 
-                "x_norm": norm_x
-            })
-
         if output_json_path:
-            with open(output_json_path, "w") as f:
-                json.dump(buildings_data, f, indent=2)
             print(f"💾 Saved data to: {output_json_path}")
-            
-    else:
-        print("\n⚠️ No structured points found in text response.")
+        return _build_buildings(matches)
 
-    return buildings_data
+    print("\n⚠️ No structured points found in text response.")
+    return []
 
 if __name__ == "__main__":
     # Test block
@@ -0,0 +1,9 @@
+"""
+WSGI entry point for running the app under a production server, e.g.:
+
+    gunicorn -w 2 -k gthread --threads 16 --timeout 120 wsgi:app
+"""
+
+from app import app
+
+application = app